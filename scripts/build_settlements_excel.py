@@ -13,13 +13,19 @@
 """
 
 import argparse
+import io
+import itertools
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from lxml import etree
 import pandas as pd
+import xlsxwriter
 
 WIKI_URLS = [
     ("Краснодарский край", "https://ru.wikipedia.org/wiki/%D0%9D%D0%B0%D1%81%D0%B5%D0%BB%D1%91%D0%BD%D0%BD%D1%8B%D0%B5_%D0%BF%D1%83%D0%BD%D0%BA%D1%82%D1%8B_%D0%9A%D1%80%D0%B0%D1%81%D0%BD%D0%BE%D0%B4%D0%B0%D1%80%D1%81%D0%BA%D0%BE%D0%B3%D0%BE_%D0%BA%D1%80%D0%B0%D1%8F"),
@@ -30,124 +36,310 @@ HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36"
 }
 
-def load_html(url: str, html_dir: str | None) -> str:
-    if html_dir:
-        parsed = urlparse(url)
-        fname = re.sub(r'[^a-zA-Z0-9._-]+', '_', parsed.path) + ".html"
-        path = os.path.join(html_dir, fname)
-        with open(path, "r", encoding="utf-8") as f:
+# Шаблоны ниже, кроме PAT_FNAME, в .str.replace передаём строкой (.pattern): для Arrow-колонок
+# pandas гоняет скомпилированный re.Pattern поэлементно в Python, а строку — в RE2-ядре pyarrow.
+# Поэтому в них не должно быть конструкций, которых нет в RE2 (lookahead и т. п.).
+
+# Всё, кроме безопасных символов, в имени файла кэша/офлайн-копии
+PAT_FNAME = re.compile(r"[^a-zA-Z0-9._-]+")
+# Сноски вида [1], [прим. 2]
+PAT_BRACKETS = re.compile(r"\[[^\]]*\]")
+# Нормализация «района/ГО»: префикс «город»/«город-курорт» и сноски [..] ...
+PAT_DISTRICT = re.compile(r"^\s*(?:город-?курорт|город)\s+|\s*\[.*?\]\s*")
+# ... затем хвост «(ГО)»; отдельным проходом, чтобы сноски после скобок уже были сняты
+PAT_PAREN_TAIL = re.compile(r"\s*\(.*?\)\s*$")
+# Имя НП — без скобок с примечаниями и сносок
+PAT_NAME = re.compile(r"\s+\(.*?\)$|\s*\[.*?\]\s*")
+
+# Классы, которыми в ruwiki оформляют таблицы-списки
+LIST_TABLE_CLASSES = {"wikitable", "standard"}
+# Служебные таблицы Wikipedia — в них заведомо нет списков НП
+SKIP_TABLE_CLASSES = {"infobox", "navbox", "vertical-navbox", "metadata", "sidebar"}
+
+# Одна сессия на все запросы: keep-alive и пул соединений к ru.wikipedia.org
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8,
+                                      max_retries=Retry(total=3, backoff_factor=0.3)))
+
+def html_path(url: str, directory: str) -> str:
+    parsed = urlparse(url)
+    fname = PAT_FNAME.sub("_", parsed.path) + ".html"
+    return os.path.join(directory, fname)
+
+def load_html(url: str, cache_dir: str | None = None) -> bytes:
+    # Кэш на диске: рядом с HTML храним ETag и спрашиваем Wikipedia, изменилась ли страница
+    path = html_path(url, cache_dir) if cache_dir else None
+    headers = {}
+    if path and os.path.exists(path) and os.path.exists(path + ".etag"):
+        with open(path + ".etag", "r", encoding="utf-8") as f:
+            headers["If-None-Match"] = f.read().strip()
+
+    resp = SESSION.get(url, headers=headers, timeout=60)
+    if resp.status_code == 304:
+        with open(path, "rb") as f:
             return f.read()
-    resp = requests.get(url, headers=HEADERS, timeout=60)
     resp.raise_for_status()
-    resp.encoding = "utf-8"
-    return resp.text
 
-def headline_for(node) -> str | None:
-    """Берёт ближайший предыдущий H3/H2; если есть span.mw-headline — используем его текст."""
-    h = node.find_previous(["h3", "h2"])
-    if not h:
-        return None
-    span = h.find("span", class_="mw-headline")
-    if span:
-        return span.get_text(strip=True)
-    return h.get_text(" ", strip=True)
-
-def choose_name_column(df: pd.DataFrame) -> str | None:
-    # Ищем колонку с названием НП
-    for c in map(str, df.columns):
-        lc = c.lower()
-        if ("насел" in lc and "пункт" in lc) or lc in ("населённый пункт", "населенный пункт"):
-            return c
-        if lc in ("название", "наименование"):
-            return c
-    for c in map(str, df.columns):
-        if "пункт" in c.lower() or "назв" in c.lower():
-            return c
+    if path:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(resp.content)
+        etag = resp.headers.get("ETag")
+        if etag:
+            with open(path + ".etag", "w", encoding="utf-8") as f:
+                f.write(etag)
+        elif os.path.exists(path + ".etag"):
+            os.remove(path + ".etag")
+    return resp.content
+
+def node_text(node) -> str:
+    """Текст узла с пробелами между фрагментами (аналог get_text(" ", strip=True))."""
+    return " ".join(t.strip() for t in node.itertext() if t.strip())
+
+def headline_text(h) -> str:
+    """Текст заголовка; если есть span.mw-headline — используем его текст."""
+    spans = h.xpath('.//span[contains(concat(" ", normalize-space(@class), " "), " mw-headline ")]')
+    if spans:
+        return node_text(spans[0])
+    return node_text(h)
+
+def clean_names(raw: list[str]) -> pd.Series:
+    """Убирает сноски и крайние пробелы сразу у всех значений (векторно)."""
+    return pd.Series(raw, dtype="string[pyarrow]").str.replace(PAT_BRACKETS.pattern, "", regex=True).str.strip()
+
+def choose_name_column(columns: list[str]) -> int | None:
+    # Ищем колонку с названием НП за один проход: точное совпадение сразу,
+    # первое «похожее» запоминаем на случай, если точного не будет
+    fallback = None
+    for i, lc in enumerate(c.lower() for c in columns):
+        if ("насел" in lc and "пункт" in lc) or lc in ("название", "наименование"):
+            return i
+        if fallback is None and ("пункт" in lc or "назв" in lc):
+            fallback = i
+    if fallback is not None:
+        return fallback
     # fallback: если вторая колонка похожа на имя (часто так)
-    if df.shape[1] >= 2:
-        return str(df.columns[1])
+    if len(columns) >= 2:
+        return 1
     return None
 
-def harvest_region(region_name: str, url: str, html_dir: str | None) -> pd.DataFrame:
-    html = load_html(url, html_dir)
-    soup = BeautifulSoup(html, "lxml")
+def is_list_table(table) -> bool:
+    """Дешёвая проверка по классам: списки НП оформлены как wikitable или standard."""
+    cls = set((table.get("class") or "").split())
+    return bool(cls & LIST_TABLE_CLASSES) and not cls & SKIP_TABLE_CLASSES
 
-    rows = []
+def drop_hidden(table) -> None:
+    """Как read_html(displayed_only=True): убирает <style> и узлы с display:none, хвостовой текст сохраняет."""
+    for el in table.xpath('.//style | .//*[contains(translate(@style, " ", ""), "display:none")]'):
+        parent = el.getparent()
+        if el.tail:
+            prev = el.getprevious()
+            if prev is not None:
+                prev.tail = (prev.tail or "") + el.tail
+            else:
+                parent.text = (parent.text or "") + el.tail
+        parent.remove(el)
 
-    # 1) Проходим все таблицы страницы; для каждой ищем колонку "населенный пункт"
-    for table in soup.select("table"):
-        try:
-            df = pd.read_html(str(table), flavor="lxml")[0]
-        except Exception:
-            continue
+def span(cell, attr: str) -> int:
+    try:
+        return max(int(cell.get(attr) or 1), 1)
+    except ValueError:
+        return 1
+
+def table_grid(trs) -> list[list[str]]:
+    """Текст ячеек по строкам с раскрытыми rowspan/colspan (как в pd.read_html)."""
+    grid = []
+    remainder = []  # (колонка, текст, сколько ещё строк) — ячейки, растянутые сверху
+    for tr in trs:
+        texts, next_remainder = [], []
+        for cell in tr.iterchildren("th", "td"):
+            while remainder and remainder[0][0] <= len(texts):
+                prev_col, prev_text, prev_rows = remainder.pop(0)
+                texts.append(prev_text)
+                if prev_rows > 1:
+                    next_remainder.append((prev_col, prev_text, prev_rows - 1))
+            text = " ".join("".join(cell.itertext()).split())
+            rows = span(cell, "rowspan")
+            for _ in range(span(cell, "colspan")):
+                if rows > 1:
+                    next_remainder.append((len(texts), text, rows - 1))
+                texts.append(text)
+        for prev_col, prev_text, prev_rows in remainder:
+            texts.append(prev_text)
+            if prev_rows > 1:
+                next_remainder.append((prev_col, prev_text, prev_rows - 1))
+        grid.append(texts)
+        remainder = next_remainder
+    return grid
+
+def table_names(table) -> list[str] | None:
+    """Сырые значения колонки с названием НП; None, если таблица не «наша»."""
+    trs = table.xpath("./tr | ./thead/tr | ./tbody/tr | ./tfoot/tr")
+    if not trs:
+        return None
+    drop_hidden(table)
 
-        name_col = choose_name_column(df)
-        if not name_col:
-            continue  # это не "наша" таблица
+    # Шапка — ведущие строки из одних <th>; как и read_html, раскрываем её отдельно от тела,
+    # чтобы rowspan из шапки не «протекал» в данные. Многоярусную склеиваем по колонкам.
+    n_head = 0
+    while n_head < len(trs) and next(trs[n_head].iterchildren("td"), None) is None:
+        n_head += 1
+    head, body = table_grid(trs[:n_head]), table_grid(trs[n_head:])
+    if head:
+        header = [" ".join(dict.fromkeys(t for t in col if t))
+                  for col in itertools.zip_longest(*head, fillvalue="")]
+    elif body:
+        header = [str(i) for i in range(len(body[0]))]  # без шапки — номера колонок, как у read_html
+    else:
+        return None
+    idx = choose_name_column(header)
+    if idx is None:
+        return None
+
+    return [row[idx] for row in body if idx < len(row)]
+
+def prune_parsed(node) -> None:
+    """Удаляет уже разобранное перед node: его предыдущих соседей и соседей всех его предков.
+
+    Внутри ещё не закрытых таблиц и списков ничего не трогаем — они нужны целиком на своём "end".
+    """
+    if next(node.iterancestors("table", "ul", "ol"), None) is not None:
+        return
+    parent = node.getparent()
+    while parent is not None:
+        while node.getprevious() is not None:
+            del parent[0]
+        node, parent = parent, parent.getparent()
+
+def parsed_nodes(source):
+    """Узлы h2/h3/table/ul по событию "end"; после обработки узла дерево перед ним подчищается."""
+    events = etree.iterparse(source, events=("end",), tag=("h2", "h3", "table", "ul"),
+                             html=True, encoding="utf-8")
+    for _, node in events:
+        yield node
+        prune_parsed(node)
+
+def harvest_region(region_name: str, url: str, html_dir: str | None, cache_dir: str | None = None) -> pd.DataFrame:
+    if html_dir:
+        source = html_path(url, html_dir)  # файл парсер читает по частям
+    else:
+        source = io.BytesIO(load_html(url, cache_dir))
 
-        unit = headline_for(table)
-        if not unit:
+    # Сырые значения со всей страницы; чистим их одним векторным проходом в конце
+    raw_units, raw_names, from_list = [], [], []
+
+    heading = None      # последний встреченный H2/H3
+    unit = None         # его текст; считаем один раз и только когда он нужен
+    section = None      # родитель заголовка: UL берём только среди соседей заголовка
+    ul_taken = True     # из секции берём только первый UL
+
+    # Один потоковый проход по документу: таблицы и списки относим к последнему заголовку.
+    # Событие "end" приходит, когда узел разобран целиком; разобранное сразу удаляется из дерева,
+    # а заголовок и его родитель живут, пока на них есть ссылки в heading/section.
+    for node in parsed_nodes(source):
+        if node.tag in ("h2", "h3"):
+            heading, unit = node, None
+            # как find_next_sibling("ul"): только соседи самого заголовка; в новой разметке
+            # (h2 внутри div.mw-heading) соседей нет, и ссылочные списки секций не попадают
+            section = node.getparent()
+            ul_taken = False
             continue
 
-        # чистим и складываем строки
-        for raw in df[name_col].astype(str).tolist():
-            name = re.sub(r"\[[^\]]*\]", "", raw).strip()
-            if not name or name == "—":
+        # 1) Таблица: ищем колонку "населенный пункт"
+        if node.tag == "table":
+            raw = table_names(node) if heading is not None and is_list_table(node) else None
+            node.clear(keep_tail=True)  # хвост — текст родителя после узла
+            if raw is None:
+                continue  # это не "наша" таблица
+            if unit is None:
+                unit = headline_text(heading)
+            if not unit:
                 continue
-            rows.append({"Регион": region_name, "Район": unit, "Населенный пункт": name})
+            raw_units.extend([unit] * len(raw))
+            raw_names.extend(raw)
+            from_list.extend([False] * len(raw))
 
-    # 2) На всякий — некоторые секции могут быть списками UL (редко)
-    for h in soup.select("h2, h3"):
-        unit = headline_for(h)  # по сути текст самого заголовка
-        ul = h.find_next_sibling("ul")
-        if not ul:
-            continue
-        items = [li.get_text(" ", strip=True) for li in ul.select(":scope > li")]
-        for raw in items:
-            name = re.sub(r"\[[^\]]*\]", "", raw).strip()
-            if not name or len(name) > 100:
+        # 2) На всякий — некоторые секции могут быть списками UL (редко)
+        elif not ul_taken and node.getparent() is section:
+            ul_taken = True
+            raw = [node_text(li) for li in node.iterchildren("li")]
+            node.clear(keep_tail=True)
+            if unit is None:
+                unit = headline_text(heading)
+            if not unit:
                 continue
-            rows.append({"Регион": region_name, "Район": unit, "Населенный пункт": name})
+            raw_units.extend([unit] * len(raw))
+            raw_names.extend(raw)
+            from_list.extend([True] * len(raw))
+
+    # чистим и складываем строки: в таблицах отбрасываем «—», в списках — слишком длинные пункты
+    cleaned = clean_names(raw_names)
+    is_list = pd.Series(from_list, dtype=bool)
+    keep = (cleaned != "") & ~(~is_list & (cleaned == "—")) & ~(is_list & (cleaned.str.len() > 100))
 
-    out = pd.DataFrame(rows).drop_duplicates().reset_index(drop=True)
+    units, names = [], []  # колонки результата; «Регион» одинаков для всей страницы
+    seen = set()           # (район, НП): дубликаты отсекаем до сборки DataFrame
+    for unit, name, ok in zip(raw_units, cleaned.tolist(), keep.tolist()):
+        if ok and (unit, name) not in seen:
+            seen.add((unit, name))
+            units.append(unit)
+            names.append(name)
+
+    # Текстовые колонки храним в Arrow: меньше памяти, str-операции дальше идут без Python-объектов
+    out = pd.DataFrame({"Регион": region_name, "Район": units, "Населенный пункт": names}).astype({
+        "Регион": "string[pyarrow]", "Район": "string[pyarrow]", "Населенный пункт": "string[pyarrow]",
+    })
     return out
 
+def write_excel(df: pd.DataFrame, path: str, sheet_name: str) -> None:
+    """Пишет таблицу построчно через xlsxwriter в режиме constant_memory.
+
+    pandas.to_excel отдаёт ячейки по колонкам, а constant_memory сбрасывает строку
+    на диск при переходе к следующей, поэтому строки пишем сами, по порядку.
+    """
+    wb = xlsxwriter.Workbook(path, {"constant_memory": True})
+    ws = wb.add_worksheet(sheet_name)
+    # шапка оформлена так же, как у to_excel
+    header_fmt = wb.add_format({"bold": True, "border": 1, "align": "center", "valign": "top"})
+    for j, name in enumerate(df.columns):
+        ws.write_string(0, j, name, header_fmt)
+    for i, row in enumerate(df.itertuples(index=False, name=None), start=1):
+        for j, value in enumerate(row):
+            ws.write_string(i, j, value)
+    wb.close()
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--out", default="data/settlements.xlsx")
     ap.add_argument("--html-dir", default=None)
+    ap.add_argument("--cache-dir", default=None, help="кэш HTML с ETag: повторный запуск качает только изменившиеся страницы")
     args = ap.parse_args()
 
-    frames = []
-    for region, url in WIKI_URLS:
-        df = harvest_region(region, url, args.html_dir)
-        frames.append(df)
+    # Страницы регионов качаем параллельно через общий SESSION
+    with ThreadPoolExecutor(max_workers=len(WIKI_URLS)) as pool:
+        frames = list(pool.map(lambda ru: harvest_region(ru[0], ru[1], args.html_dir, args.cache_dir), WIKI_URLS))
 
     if not frames or all(df.empty for df in frames):
         raise RuntimeError("Парсер не нашёл таблиц с населёнными пунктами. Проверьте структуру страниц Wikipedia.")
 
     result = pd.concat(frames, ignore_index=True)
 
-    # Нормализация «района/ГО»
+    # Нормализация «района/ГО» и имён
     result["Район"] = (
         result["Район"]
-        .str.replace(r"^\s*город-?курорт\s+", "", regex=True)
-        .str.replace(r"^\s*город\s+", "", regex=True)
-        .str.replace(r"\s*\[.*?\]\s*", "", regex=True)
+        .str.replace(PAT_DISTRICT.pattern, "", regex=True)
+        .str.replace(PAT_PAREN_TAIL.pattern, "", regex=True)
         .str.strip()
     )
-    # Уберём хвосты типа "(ГО)" в названии единицы
-    result["Район"] = result["Район"].str.replace(r"\s*\(.*?\)\s*$", "", regex=True).str.strip()
-
-    # Имя — без скобок с примечаниями
-    result["Населенный пункт"] = result["Населенный пункт"].str.replace(r"\s+\(.*?\)$", "", regex=True).str.strip()
+    result["Населенный пункт"] = result["Населенный пункт"].str.replace(PAT_NAME.pattern, "", regex=True).str.strip()
 
-    # Сортировка
-    result.sort_values(by=["Регион", "Район", "Населенный пункт"], inplace=True, key=lambda s: s.str.lower())
+    # Сортировка без учёта регистра: ключи в нижнем регистре считаем один раз
+    keys = {"_r": result["Регион"].str.lower(), "_d": result["Район"].str.lower(), "_n": result["Населенный пункт"].str.lower()}
+    result = result.assign(**keys).sort_values(list(keys)).drop(columns=list(keys)).reset_index(drop=True)
 
     os.makedirs(os.path.dirname(args.out), exist_ok=True)
-    with pd.ExcelWriter(args.out, engine="openpyxl") as xw:
-        result.to_excel(xw, sheet_name="Населенные пункты", index=False)
+    write_excel(result, args.out, sheet_name="Населенные пункты")
 
     print(f"Готово: {args.out} (строк: {len(result)})")
 
@@ -0,0 +1,66 @@
+import io
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "scripts"))
+
+import build_settlements_excel as b  # noqa: E402
+
+FIXTURES = ROOT / "tests" / "fixtures"
+URL = "https://ru.wikipedia.org/wiki/Sample"
+
+
+def harvest() -> pd.DataFrame:
+    return b.harvest_region("Регион", URL, str(FIXTURES))
+
+
+def test_tables_follow_spans_hidden_text_and_headerless_layout():
+    df = harvest()
+    got = list(zip(df["Район"], df["Населенный пункт"]))
+    assert got == [
+        ("Город-курорт Анапа", "Анапа"),
+        ("Город-курорт Анапа", "Витязево"),
+        ("Город-курорт Анапа", "Джемете (не выделен)"),
+        ("Абинский район", "Абинск"),
+        ("Абинский район", "Новый Хутор"),
+        ("Новороссийск", "Абрау-Дюрсо"),
+        ("Новороссийск", "Мысхако"),
+        ("Новороссийск", "Глебовка"),
+        ("Темрюкский район", "Темрюк"),
+        ("Темрюкский район", "Аул Хвостовой"),
+        ("Северский район", "Северская"),
+        ("Северский район", "Ильский"),
+    ]
+
+
+def test_lists_only_next_to_the_heading_itself():
+    # «См. также» в div.mw-heading: соседей у h2 нет, ссылки не должны стать НП
+    assert "См. также" not in set(harvest()["Район"])
+
+
+def test_name_column_matches_read_html():
+    html = (FIXTURES / "_wiki_Sample.html").read_text(encoding="utf-8")
+    expected = pd.read_html(io.StringIO(html), attrs={"class": "wikitable sortable"})[0]["Населённый пункт"]
+    expected = expected.str.replace(b.PAT_BRACKETS, "", regex=True).str.strip().tolist()
+    df = harvest()
+    assert df.loc[df["Район"] == "Город-курорт Анапа", "Населенный пункт"].tolist() == expected
+
+
+def test_parsed_nodes_prune_processed_tree():
+    last = None
+    for last in b.parsed_nodes(str(FIXTURES / "_wiki_Sample.html")):
+        pass
+    # от документа остаётся только цепочка предков последнего узла
+    assert sum(1 for _ in last.getroottree().iter()) < 10
+
+
+def test_text_patterns_run_in_pyarrow_re2():
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    # шаблоны идут в .str.replace строкой; RE2 не знает lookahead и т. п. — упадёт здесь
+    for pat in (b.PAT_BRACKETS, b.PAT_DISTRICT, b.PAT_PAREN_TAIL, b.PAT_NAME):
+        pc.replace_substring_regex(pa.array(["город Сочи (ГО) [1]"]), pattern=pat.pattern, replacement="")